@@ -0,0 +1,105 @@
+"""Helpers shared by the scripts that call geocoding and routing APIs.
+
+Responses are cached on disk under `.cache/` at the top of the repo, so re-running a script only hits
+the network for postcodes/streets that haven't been seen before. Delete that directory to force fresh
+results.
+"""
+
+import atexit
+import functools
+import hashlib
+import json
+import pathlib
+import shelve
+import threading
+import time
+import typing
+
+import requests
+
+from urllib3.util.retry import Retry
+
+CACHE_DIR = pathlib.Path(__file__).absolute().parent.parent.joinpath('.cache')
+
+# Shared session so repeated API calls reuse connections rather than a fresh TCP/TLS handshake each time
+session = requests.Session()
+adapter = requests.adapters.HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+)
+session.mount('http://', adapter)
+session.mount('https://', adapter)
+
+
+class TokenBucket:
+    """Thread-safe rate limiter allowing bursts of up to `capacity` calls, topped up at `rate` per second"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take a token, sleeping until it would have been available if the bucket is empty"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= 1  # can go negative, later callers then queue up behind this one
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+# The public OSRM demo server has low rate limits and bans IPs that hammer it
+osrm_rate_limit = TokenBucket(rate=1, capacity=5)
+
+
+def cache_key(*params) -> str:
+    """Stable hash of API call parameters, floats rounded to 6 d.p. (~10cm) so float noise still hits"""
+    params = [round(float(p), 6) if isinstance(p, float) else p for p in params]
+    return hashlib.sha1(json.dumps(params).encode()).hexdigest()
+
+
+class ApiCache:
+    """Thread-safe on-disk store of API results, one file per `name` under `CACHE_DIR`"""
+
+    def __init__(self, name: str):
+        # Opened once so every lookup during a run reuses the same handle
+        CACHE_DIR.mkdir(exist_ok=True)
+        self.shelf = shelve.open(str(CACHE_DIR.joinpath(name)))
+        self.lock = threading.Lock()  # shelve isn't thread-safe
+        atexit.register(self.shelf.close)
+
+    def get(self, key: str) -> typing.Any:
+        """Cached result for `key`, or `None` if there isn't one"""
+        with self.lock:
+            return self.shelf.get(key)
+
+    def update(self, results: typing.Dict[str, typing.Any]) -> None:
+        """Store `results` (key to result) and write them to disk"""
+        with self.lock:
+            self.shelf.update(results)
+            self.shelf.sync()
+
+    def cached(self, func: typing.Callable) -> typing.Callable:
+        """Decorator memoising an API call in memory and on disk, so re-running doesn't re-query.
+
+        Only positional arguments are supported, they form the cache key along with the function name.
+        """
+
+        @functools.lru_cache(maxsize=None)
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = cache_key(func.__name__, *args)
+            with self.lock:
+                if key in self.shelf:
+                    return self.shelf[key]
+            result = func(*args)  # don't hold the lock over the network call
+            self.update({key: result})
+            return result
+
+        return wrapper
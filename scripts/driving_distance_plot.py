@@ -7,21 +7,24 @@ because of mopeds driving through?) - as of 23 Nov 2021.
 
 Therefore settled on using the following:
 
-- BEFORE state: Google Directions API, in cycling mode
+- BEFORE state: Google Distance Matrix API (same routing as Directions API), in cycling mode
     - The only real traffic-free cycle route in this region is the ring road path which runs
     East-West, whereas these journeys are North-South.
     - After a bit of spot checking decided this was sufficiently good approximation to the "before"
     state
-    - This requires a Google Directions API key to get this part to work, see
-        https://developers.google.com/maps/documentation/directions/overview
+    - This requires a Google API key with the Distance Matrix API enabled to get this part to work
+    (the Directions API too if using `get_distance_google_direcions_api` directly), see
+        https://developers.google.com/maps/documentation/distance-matrix/overview
 - AFTER state: cannot use Google Directions API here because of the missing Littlemore Road filter
     - Use Open Source Routing Machine: http://project-osrm.org/
     - This API only works for driving (i.e. not cycling or walking) so annoyingly can't use for the
     "before" state too
 
-You may get rate limited if you try to run this script too many times in quick succession. If
-playing around with the graph I strongly recommend dumping the routing results to file first to
-cut down on API calls (Google will start charging you and OSRM is an Open Source resource).
+You may get rate limited if you try to run this script too many times in quick succession. To cut
+down on API calls (Google will start charging you and OSRM is an Open Source resource) every
+geocoding and routing response is cached on disk under `.cache/` at the top of the repo, so re-runs
+only hit the network for postcodes/streets that haven't been seen before. Delete that directory to
+force fresh results.
 
 Setting environment variables
 -----------------------------
@@ -29,7 +32,9 @@ Setting environment variables
 You need two environment variables for this script to work:
 
 - USER_EMAIL (for geo-coding)
-- GOOGLE_DIRECTIONS_API_KEY (for Google Directions API to work)
+- GOOGLE_DIRECTIONS_API_KEY (the Distance Matrix API must be enabled for this key, it's a separate
+  API to Directions. Also used for Google Geocoding API if enabled for the key - otherwise geo-coding
+  falls back to Nominatim)
 
 Set both by doing:
 
@@ -57,33 +62,101 @@ Notes
 """
 
 import argparse
-import json
+import concurrent.futures
 import os
 import pathlib
 import typing
 
 import geopy
-import requests
+import orjson
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
-from geopy.geocoders import Nominatim
+from geopy.exc import GeocoderAuthenticationFailure, GeocoderQueryError
+from geopy.extra.rate_limiter import RateLimiter
+from geopy.geocoders import GoogleV3, Nominatim
+
+from api_helpers import ApiCache, cache_key, osrm_rate_limit, session
 
 USER_AGENT = os.environ['USER_EMAIL']
 API_KEY = os.environ['GOOGLE_DIRECTIONS_API_KEY']
 TEMPLARS_SHOPPING_PARK = (51.732612, -1.218179)
+GOOGLE_DIRECTIONS_URL = 'https://maps.googleapis.com/maps/api/directions/json'
+GOOGLE_DISTANCE_MATRIX_URL = 'https://maps.googleapis.com/maps/api/distancematrix/json'
+GOOGLE_MATRIX_MAX_ORIGINS = 25  # Distance Matrix API limit per request
+OSRM_TABLE_MAX_COORDS = 100  # keep well within the public server's limits
 
 geolocator = Nominatim(user_agent=USER_AGENT)
 
+# Google geocodes postcodes better and allows many requests per second, so try it first. Nominatim
+# (OpenStreetMap) is the fallback and its usage policy asks for at most 1 request per second. Google
+# errors aren't retried or swallowed, so a key without Geocoding enabled falls back straight away.
+google_geocode = RateLimiter(
+    GoogleV3(api_key=API_KEY).geocode, min_delay_seconds=0.05, max_retries=0, swallow_exceptions=False
+)
+nominatim_geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1, max_retries=3, error_wait_seconds=5)
+
+api_cache = ApiCache('routing')
+
+
+def morton_key(lat: float, lon: float, bits: int = 24) -> int:
+    """Position of a lat-long along a Z-order curve, so sorting by it keeps nearby locations together.
+
+    Same bit interleaving as a geohash, without the base32 string. 24 bits a side is roughly 1m.
+    """
+    scale = (1 << bits) - 1
+    x = int((lon + 180) / 360 * scale)
+    y = int((lat + 90) / 180 * scale)
+    key = 0
+    for bit in range(bits):
+        key |= ((x >> bit) & 1) << (2 * bit + 1) | ((y >> bit) & 1) << (2 * bit)
+    return key
+
+
+def cached_batch_api_call(
+    keys: typing.List[str],
+    fetch: typing.Callable[[typing.List[int]], typing.List[float]],
+    chunk_size: int,
+    sort_key: typing.Optional[typing.Callable[[int], typing.Any]] = None,
+) -> typing.List[float]:
+    """Look up `keys` in the API cache, calling `fetch` for the indices of any that are missing.
+
+    `fetch` is given at most `chunk_size` indices at a time and returns one result per index, in order.
+    Missing indices are grouped into chunks in `sort_key` order, results come back in `keys` order.
+    `None` results aren't cached, so they're asked for again next time.
+    """
+    results = [api_cache.get(key) for key in keys]
+    missing = sorted((i for i, result in enumerate(results) if result is None), key=sort_key)
+
+    for start in range(0, len(missing), chunk_size):
+        chunk = missing[start:start + chunk_size]
+        fetched = fetch(chunk)
+        if len(fetched) != len(chunk):
+            raise RuntimeError(f'Expected {len(chunk)} results from API, got {len(fetched)}')
+        for i, result in zip(chunk, fetched):
+            results[i] = result
+        api_cache.update({keys[i]: results[i] for i in chunk if results[i] is not None})
 
+    return results
+
+
+@api_cache.cached
 def get_lat_long_from_postcode(postcode: str) -> typing.Tuple[float, float]:
-    """Get lat-long of a postcode"""
-    location = geolocator.geocode(postcode)
+    """Get lat-long of a postcode, using Google Geocoding API and falling back to Nominatim"""
+    try:
+        location = google_geocode(postcode)
+    except (GeocoderAuthenticationFailure, GeocoderQueryError):  # e.g. Geocoding API not enabled for key
+        location = None
+    if location is None:
+        location = nominatim_geocode(postcode)
+    if location is None:
+        raise ValueError(f'Could not geocode postcode {postcode!r} with Google or Nominatim')
     return (location.latitude, location.longitude)
 
 
+@api_cache.cached
 def get_distance_google_direcions_api(
     lat_from: float, lon_from: float, lat_to: float, lon_to: float, mode: str
 ) -> float:
@@ -92,42 +165,132 @@ def get_distance_google_direcions_api(
     `mode` is mode of travel, one of `driving`, `walking`, `bicycling`, `transit`.
     See https://developers.google.com/maps/documentation/directions/get-directions#TravelModes
     """
-    r = requests.get(
-        f"https://maps.googleapis.com/maps/api/directions/json?origin={lat_from},+{lon_from}&destination={lat_to},+{lon_to}&mode={mode}&key={API_KEY}"
-    )
-    routes = json.loads(r.content)
+    params = {
+        'origin': f'{lat_from},{lon_from}',
+        'destination': f'{lat_to},{lon_to}',
+        'mode': mode,
+        'key': API_KEY,
+    }
+    r = session.get(GOOGLE_DIRECTIONS_URL, params=params, timeout=10)
+    routes = orjson.loads(r.content)
     return routes.get("routes")[0]['legs'][0]['distance']['value']
 
 
+@api_cache.cached
 def get_distance_osrm_api(lat_from: float, lon_from: float, lat_to: float, lon_to: float) -> float:
     """Get driving distance (in meters) between two locations using OSRM API.
 
     Note the unexpected order of the lat/long in the API call.
     """
-    r = requests.get(
-        f"http://router.project-osrm.org/route/v1/driving/{lon_from},{lat_from};{lon_to},{lat_to}?overview=false"
-        ""
+    osrm_rate_limit.acquire()
+    r = session.get(
+        f"http://router.project-osrm.org/route/v1/driving/{lon_from},{lat_from};{lon_to},{lat_to}?overview=false",
+        timeout=10,
     )
-    routes = json.loads(r.content)
+    routes = orjson.loads(r.content)
     return routes.get("routes")[0]['distance']
 
 
+def get_distances_osrm_table(
+    origins: typing.List[typing.Tuple[float, float]], destination: typing.Tuple[float, float]
+) -> typing.List[float]:
+    """Get driving distances (in meters) from many locations to one location using OSRM table API.
+
+    Makes one request per `OSRM_TABLE_MAX_COORDS` coordinates rather than one per origin. Shares its
+    cache with `get_distance_osrm_api`, so only origins that haven't been routed before are requested.
+    Origins OSRM can't route from come back as `None`.
+    """
+    lat_to, lon_to = destination
+
+    def fetch(chunk: typing.List[int]) -> typing.List[float]:
+        coords = ';'.join(f'{lon},{lat}' for lat, lon in [origins[i] for i in chunk] + [destination])
+        sources = ';'.join(str(i) for i in range(len(chunk)))
+        osrm_rate_limit.acquire()
+        r = session.get(
+            f"http://router.project-osrm.org/table/v1/driving/{coords}?sources={sources}&destinations={len(chunk)}"
+            "&annotations=distance",
+            timeout=10,
+        )
+        table = orjson.loads(r.content)
+        if table.get('code') != 'Ok':
+            raise RuntimeError(f"OSRM table request failed: {table.get('code')} {table.get('message', '')}")
+        distances = [row[0] for row in table['distances']]
+        for i, distance in zip(chunk, distances):
+            if distance is None:
+                print(f'OSRM could not route from {origins[i]}, distance left blank')
+        return distances
+
+    keys = [cache_key(get_distance_osrm_api.__name__, lat, lon, lat_to, lon_to) for lat, lon in origins]
+    chunk_size = OSRM_TABLE_MAX_COORDS - 1  # leave room for the destination
+    # Neighbouring origins share most of their route, so batch them together for the router
+    return cached_batch_api_call(keys, fetch, chunk_size, sort_key=lambda i: morton_key(*origins[i]))
+
+
+def get_distances_google_matrix(
+    origins: typing.List[typing.Tuple[float, float]], destination: typing.Tuple[float, float], mode: str
+) -> typing.List[float]:
+    """Get distances (in meters) from many locations to one location using Google Distance Matrix API.
+
+    Makes one request per `GOOGLE_MATRIX_MAX_ORIGINS` origins rather than one per origin. `mode` is as
+    for `get_distance_google_direcions_api`.
+    See https://developers.google.com/maps/documentation/distance-matrix/overview
+    """
+    lat_to, lon_to = destination
+
+    def fetch(chunk: typing.List[int]) -> typing.List[float]:
+        params = {
+            'origins': '|'.join(f'{lat},{lon}' for lat, lon in [origins[i] for i in chunk]),
+            'destinations': f'{lat_to},{lon_to}',
+            'mode': mode,
+            'key': API_KEY,
+        }
+        r = session.get(GOOGLE_DISTANCE_MATRIX_URL, params=params, timeout=10)
+        matrix = orjson.loads(r.content)
+        if matrix.get('status') != 'OK':
+            raise RuntimeError(
+                f"Distance Matrix request failed: {matrix.get('status')} {matrix.get('error_message', '')}"
+            )
+        elements = [row['elements'][0] for row in matrix['rows']]
+        for i, element in zip(chunk, elements):
+            if element['status'] != 'OK':
+                raise RuntimeError(f"Distance Matrix could not route from {origins[i]}: {element['status']}")
+        return [element['distance']['value'] for element in elements]
+
+    keys = [cache_key(get_distances_google_matrix.__name__, lat, lon, lat_to, lon_to, mode) for lat, lon in origins]
+    return cached_batch_api_call(keys, fetch, GOOGLE_MATRIX_MAX_ORIGINS, sort_key=lambda i: morton_key(*origins[i]))
+
+
 def get_driving_distance_before_ltn(lat_from: float, lon_from: float, lat_to: float, lon_to: float) -> float:
     """Driving distance from `(lat_from, lon_from)` to `(lat_to, lon_to)` before LTN installation"""
     return get_distance_google_direcions_api(lat_from, lon_from, lat_to, lon_to, 'bicycling')
 
 
+def get_driving_distances_before_ltn(
+    origins: typing.List[typing.Tuple[float, float]], lat_to: float, lon_to: float
+) -> typing.List[float]:
+    """Driving distances from each of `origins` to `(lat_to, lon_to)` before LTN installation"""
+    return get_distances_google_matrix(origins, (lat_to, lon_to), 'bicycling')
+
+
 def get_driving_distance_after_ltn(lat_from: float, lon_from: float, lat_to: float, lon_to: float) -> float:
     """Driving distance from `(lat_from, lon_from)` to `(lat_to, lon_to)` after LTN installation"""
     return get_distance_osrm_api(lat_from, lon_from, lat_to, lon_to)
 
 
+def get_driving_distances_after_ltn(
+    origins: typing.List[typing.Tuple[float, float]], lat_to: float, lon_to: float
+) -> typing.List[float]:
+    """Driving distances from each of `origins` to `(lat_to, lon_to)` after LTN installation"""
+    return get_distances_osrm_table(origins, (lat_to, lon_to))
+
+
 def update_street_data_with_distances_to_location(
     csv_file: pathlib.Path, loc_to_name_short: str, lat_to: float, lon_to: float
-) -> None:
+) -> typing.Optional[pd.DataFrame]:
     """Update street data CSV file with lat-long and LTN distance data.
 
-    Overwrites the existing file to help with unnecessary API spamming.
+    Overwrites the existing file to help with unnecessary API spamming. Also returns the updated data
+    so it can go straight into `plot_stacked_distances_graph`, or `None` if there was nothing to do.
 
     Args:
         csv_file (pathlib.Path): Location of data CSV file
@@ -135,44 +298,58 @@ def update_street_data_with_distances_to_location(
         lat_to (float): Latitude of `to` location
         lon_to (float): Longitude of `to` location
     """
-    df = pd.read_csv(csv_file)
+    columns = pd.read_csv(csv_file, nrows=0).columns  # just the header, in case there's nothing to do
 
-    if 'street' not in df.columns:
+    if 'street' not in columns:
         raise ValueError('Missing `street` column, required for graph label')
 
-    if 'postcode' not in df.columns:
+    if 'postcode' not in columns:
         raise ValueError('Missing `postcode` column, please run script `postcode_lookup.py')
 
-    if 'latitude' not in df.columns or 'longitude' not in df.columns:
-        df[['latitude', 'longitude']] = df['postcode'].apply(get_lat_long_from_postcode).tolist()
-
     before_column_name = f'driving_distance_to_{loc_to_name_short}_before'
     after_column_name = f'driving_distance_to_{loc_to_name_short}_after'
 
-    if before_column_name in df.columns and after_column_name in df.columns:
+    if before_column_name in columns and after_column_name in columns:
         print(f'Columns {before_column_name} and {after_column_name} already exist, no action taken')
-        return
+        return None
+
+    df = pd.read_csv(csv_file)
 
-    df[before_column_name] = df.apply(
-        lambda x: get_driving_distance_before_ltn(x.latitude, x.longitude, lat_to, lon_to), axis=1
-    ).astype('float64')
-    df[after_column_name] = df.apply(
-        lambda x: get_driving_distance_after_ltn(x.latitude, x.longitude, lat_to, lon_to), axis=1
-    ).astype('float64')
+    if 'latitude' not in df.columns or 'longitude' not in df.columns:
+        # Streets can share a postcode, so only geocode each one once. Geocoders are rate limited
+        # individually so a few threads are safe.
+        postcodes = df['postcode'].unique()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            lat_longs = dict(zip(postcodes, executor.map(get_lat_long_from_postcode, postcodes)))
+        df[['latitude', 'longitude']] = df['postcode'].map(lat_longs).tolist()
+
+    # Both APIs take many origins per request, so route all streets in as few calls as possible. The two
+    # APIs are on different servers so run them side by side.
+    # Plain Python floats, rather than going through pandas row by row
+    lats = df['latitude'].to_numpy(dtype=np.float64).tolist()
+    lons = df['longitude'].to_numpy(dtype=np.float64).tolist()
+    coords = list(zip(lats, lons))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        before_future = executor.submit(get_driving_distances_before_ltn, coords, lat_to, lon_to)
+        after_future = executor.submit(get_driving_distances_after_ltn, coords, lat_to, lon_to)
+        before, after = before_future.result(), after_future.result()
+    df[before_column_name] = pd.Series(before, index=df.index, dtype='float64')
+    df[after_column_name] = pd.Series(after, index=df.index, dtype='float64')
 
     df.to_csv(csv_file)  # overwrite existing file
+    return df
 
 
 def plot_stacked_distances_graph(
-    csv_file: pathlib.Path, output_png: pathlib.Path, loc_to_name_short: str, loc_to_name_full: str,
-    loc_from_name_full: str
+    data: typing.Union[pathlib.Path, pd.DataFrame], output_png: pathlib.Path, loc_to_name_short: str,
+    loc_to_name_full: str, loc_from_name_full: str
 ) -> None:
     """Create a nice stacked bar chart of the driving distances before and after LTN installation.
 
     Bars in order of increasing distance before LTN.
 
     Args:
-        csv_file (pathlib.Path): Location of data CSV file
+        data (pathlib.Path or pd.DataFrame): Location of data CSV file, or the data already loaded
         output_png (pathlib.Path): Location of output PNG file
         loc_to_name_short (str): short location to name, used in column name
         loc_to_name_full (str): long location to name, used in graph title
@@ -182,26 +359,36 @@ def plot_stacked_distances_graph(
 
     MILES_CONVERSION = 0.000621371  # meters to miles
 
-    df = pd.read_csv(csv_file)
     before_column_name = f'driving_distance_to_{loc_to_name_short}_before'
     after_column_name = f'driving_distance_to_{loc_to_name_short}_after'
-    df['diff'] = df[after_column_name] - df[before_column_name]
+    # Only need these columns, and single precision is plenty for plotting
+    columns = ['street', before_column_name, after_column_name]
+    dtypes = {before_column_name: 'float32', after_column_name: 'float32'}
+    if isinstance(data, pd.DataFrame):
+        df = data[columns].astype(dtypes)
+    else:
+        df = pd.read_csv(data, usecols=columns, dtype=dtypes)
+
+    # Work on plain arrays from here, the plot doesn't need anything from pandas
+    street = df['street'].to_numpy()
+    before = df[before_column_name].to_numpy()
+    diff = df[after_column_name].to_numpy() - before
 
     # Normalise some of the distances as routing can be a bit out
     NORM_DISTANCE = 50  # meters
-    df.loc[df["diff"] <= NORM_DISTANCE, "diff"] = 0.0
-    df.loc[df["diff"] == 0.0, after_column_name] = df[before_column_name]
-    df = df.sort_values(before_column_name)
+    diff[diff <= NORM_DISTANCE] = 0.0  # i.e. after is the same as before
+    order = np.argsort(before, kind='stable')
 
     # Plot graph
-    before = df["driving_distance_to_templars_before"] * MILES_CONVERSION
-    diff = df["diff"] * MILES_CONVERSION
-    average_distance_increase = diff.mean()
+    street = street[order]
+    before = before[order] * MILES_CONVERSION
+    diff = diff[order] * MILES_CONVERSION
+    average_distance_increase = np.nanmean(diff)
     width = 0.5
 
     _, ax = plt.subplots(figsize=(12, 8))
-    ax.bar(df['street'], before, label="Before LTN", width=width)
-    ax.bar(df['street'], diff, label="After LTN", width=width, bottom=before)
+    ax.bar(street, before, label="Before LTN", width=width)
+    ax.bar(street, diff, label="After LTN", width=width, bottom=before)
     plt.legend(loc="best")
     plt.xticks(rotation=270)
     plt.gca().set_ylim(bottom=0)  # set bottom y limit to 0
@@ -226,5 +413,7 @@ if __name__ == '__main__':
 
     assert csv_file.is_file()
 
-    update_street_data_with_distances_to_location(csv_file, 'templars', *TEMPLARS_SHOPPING_PARK)
-    plot_stacked_distances_graph(csv_file, png_file, 'templars', 'Templars Shopping Park', 'Littlemore streets')
+    df = update_street_data_with_distances_to_location(csv_file, 'templars', *TEMPLARS_SHOPPING_PARK)
+    plot_stacked_distances_graph(
+        csv_file if df is None else df, png_file, 'templars', 'Templars Shopping Park', 'Littlemore streets'
+    )
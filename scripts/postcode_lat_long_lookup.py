@@ -3,61 +3,108 @@
 Also get (driving) distances from postcodes to Littlemore Road LTN filter using
 Open Source Routing Machine: http://project-osrm.org/
 
-Done offline instead of in notebook to cut down on API calls.
+Done offline instead of in notebook to cut down on API calls. Responses are also cached on disk
+under `.cache/` at the top of the repo so re-runs don't re-query the same postcodes.
 """
 
 import csv
-import json
+import os
 import pathlib
-import requests
 import typing
 
 import geopy
+import orjson
 
+from geopy.extra.rate_limiter import RateLimiter
 from geopy.geocoders import Nominatim
 
+from api_helpers import ApiCache, osrm_rate_limit, session
+
 
 geolocator = Nominatim(user_agent="anna.railton@gmail.com")
+geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1, max_retries=3, error_wait_seconds=5)  # Nominatim policy
+
+api_cache = ApiCache('postcode_lookup')
+
 
+@api_cache.cached
 def get_lat_long(postcode: str) -> typing.Tuple[float, float]:
     """Get lat-long of a postcode"""
-    location = geolocator.geocode(postcode)
+    location = geocode(postcode)
+    if location is None:
+        raise ValueError(f'Could not geocode postcode {postcode!r}')
     return (location.latitude, location.longitude)
 
 
+@api_cache.cached
 def get_distance_to_ltn(lat: float, lon:float) -> float:
     """Get distance (in meters) to southern side of Littlemore Road LTN filter"""
 
     littlemore_ltn_filter = (51.72890, -1.21867)  # from https://www.openstreetmap.org/node/8485497325
     lat_ltn, lon_ltn = littlemore_ltn_filter
 
-    r = requests.get(f"http://router.project-osrm.org/route/v1/driving/{lon},{lat};{lon_ltn},{lat_ltn}?overview=false""")
+    osrm_rate_limit.acquire()
+    r = session.get(
+        f"http://router.project-osrm.org/route/v1/driving/{lon},{lat};{lon_ltn},{lat_ltn}?overview=false", timeout=10
+    )
 
-    routes = json.loads(r.content)
+    routes = orjson.loads(r.content)
     return routes.get("routes")[0]['distance']
 
 
 def update_street_data_with_lat_long_ltn_distance(csv_file: pathlib.Path) -> None:
-    """Update street data CSV file with lat-long and LTN distance data"""
-    data = []
-    with open(csv_file, 'r') as f:
-        reader = csv.reader(f)
-        header = next(reader)
-        header.extend(['latitude', 'longitude', 'driving_distance_to_ltn_meters'])
-        data.append(header)
-        for row in reader:
-            postcode = row[6]
-            print(f'Processing: {postcode}')
-            lat, lon = get_lat_long(postcode)
-            distance_to_ltn = get_distance_to_ltn(lat, lon)
-            if postcode == "OX4 3ST":  # Littlemore Road, don't want wrong side of filter!
-                distance_to_ltn = 0.0
-            row.extend([lat, lon, distance_to_ltn])
-            data.append(row)
-
-    with open(csv_file, 'w') as f:
-        writer = csv.writer(f)
-        writer.writerows(data)
+    """Update street data CSV file with lat-long and LTN distance data.
+
+    Rows are written out one at a time to a temporary file alongside `csv_file`, which then replaces
+    it once every row is done. If the run falls over part way through, re-running carries on from the
+    last row written rather than starting again.
+    """
+    tmp_file = csv_file.with_suffix('.tmp')
+    start_again = f'delete {tmp_file} to start again'
+
+    with open(csv_file, 'r', newline='') as f_in:
+        reader = csv.DictReader(f_in)
+        fieldnames = reader.fieldnames + ['latitude', 'longitude', 'driving_distance_to_ltn_meters']
+
+        # Only resume from a temporary file that came from this input
+        done_postcodes = []
+        if tmp_file.is_file():
+            with open(tmp_file, 'r', newline='') as f:
+                tmp_reader = csv.DictReader(f)
+                if tmp_reader.fieldnames is not None and tmp_reader.fieldnames != fieldnames:
+                    raise ValueError(f'{tmp_file} has different columns to {csv_file}, {start_again}')
+                done_postcodes = [row['postcode'] for row in tmp_reader]
+            print(f'Resuming from {tmp_file}, {len(done_postcodes)} rows already done')
+
+        with open(tmp_file, 'a', newline='') as f_out:
+            writer = csv.DictWriter(f_out, fieldnames=fieldnames)
+            if f_out.tell() == 0:
+                writer.writeheader()
+            num_rows = 0
+            for num_rows, row in enumerate(reader, start=1):
+                postcode = row['postcode']
+                if num_rows <= len(done_postcodes):
+                    if postcode != done_postcodes[num_rows - 1]:
+                        raise ValueError(
+                            f'Row {num_rows} is {postcode} in {csv_file} but {done_postcodes[num_rows - 1]} in '
+                            f'{tmp_file}, {start_again}'
+                        )
+                    continue
+                lat, lon = get_lat_long(postcode)
+                distance_to_ltn = get_distance_to_ltn(lat, lon)
+                if postcode == "OX4 3ST":  # Littlemore Road, don't want wrong side of filter!
+                    distance_to_ltn = 0.0
+                writer.writerow(
+                    {**row, 'latitude': lat, 'longitude': lon, 'driving_distance_to_ltn_meters': distance_to_ltn}
+                )
+                f_out.flush()
+                os.fsync(f_out.fileno())
+                print(f'{postcode}: ({lat}, {lon}), {distance_to_ltn}m to LTN filter, written to {tmp_file.name}')
+
+    if num_rows < len(done_postcodes):
+        raise ValueError(f'{tmp_file} has more rows than {csv_file}, {start_again}')
+
+    os.replace(tmp_file, csv_file)
 
 
 if __name__ == '__main__':
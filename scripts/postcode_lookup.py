@@ -1,6 +1,6 @@
 import requests
 
-from bs4 import BeautifulSoup
+from selectolax.parser import HTMLParser
 
 
 def zoopla_postcode_search(street_name: str, location_name: str) -> str:
@@ -16,10 +16,12 @@ def zoopla_postcode_search(street_name: str, location_name: str) -> str:
     street_squashed = street_name.lower().replace(' ', '-')
     url = f'https://www.zoopla.co.uk/house-prices/{location_name}/{street_squashed}'
     results = requests.get(url)
-    soup = BeautifulSoup(results.text, 'html.parser')
+    first_result = HTMLParser(results.text).css_first('.hp-card__title')
+    if first_result is None:
+        return ''
     try:
         # Select postcode from first result
-        postcode = soup.select(".hp-card__title")[0].text.strip().split(',')[1].strip()
+        postcode = first_result.text().strip().split(',')[1].strip()
         return postcode
     except IndexError:
         return ''